@@ -1,19 +1,61 @@
 #!/usr/bin/env python3
 
-import json
+import asyncio
 import getvenue as gv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import aiohttp
+import orjson
+
+# Upper bound on simultaneous connections across all venue requests
+MAX_CONNECTIONS = 20
+
+# Number of seconds a cached venue response is reused before it is requested again
+CACHE_EXPIRE = 3600
+
+
+async def write_venue(events, f):
+    """Write each event from a venue's async generator to a file as one JSON line.
+
+    Args:
+        events: an async generator of JSON-formattable event objects
+        f: the file to write to, opened in binary mode
+    """
+
+    async for ev in events:
+        f.write(orjson.dumps(ev, option=orjson.OPT_APPEND_NEWLINE))
+
+
+async def write_events(path):
+    """Request every venue calendar concurrently and write events to a newline-delimited JSON file.
+
+    Events are written as each calendar is parsed, so they are never collected into one list.
+    Bowery Boston events are parsed in a process pool whose workers are spawned rather than forked,
+    since aiohttp and the cache run helper threads that a fork could copy mid-operation.
+
+    Args:
+        path: the file to write one JSON event object per line to
+    """
+
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as pool:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            venues = [
+                gv.bowery_shows(session, pool),
+                # gv.houseofblues(session),
+                gv.monthly_cals(session)
+            ]
+            with open(path, 'wb') as f:
+                await asyncio.gather(*(write_venue(venue, f) for venue in venues))
+
 
 def main():
-    """Retrieve all events starting within the next 12 months using the getvenue module and output them to a JSON file."""
-
-    events_output = []
-    events_output += gv.bowery_shows()
-    # events_output += gv.houseofblues()
-    events_output += gv.monthly_cals()
-    with open(Path(__file__).parent / 'events.json', 'w') as f:
-        json.dump(events_output, f)
+    """Retrieve all events starting within the next 12 months using the getvenue module and output them to a JSON Lines file."""
+
+    gv.install_cache(Path(__file__).parent / '.cache', expire_after=CACHE_EXPIRE)
+    asyncio.run(write_events(Path(__file__).parent / 'events.jsonl'))
 
 
 if __name__ == '__main__':
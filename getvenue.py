@@ -2,7 +2,9 @@
 
 """A collection of functions designed to retrieve and parse various venue calendars in the Boston area.
 
-Most functions return an array of JSON-formattable event objects, which follow this template:
+The venue functions (bowery_shows, houseofblues, monthly_cals) are async generators and the per-page parsers
+(middleeast, crossroads_parse) are generators; all of them yield JSON-formattable event objects one at a time,
+which follow this template:
     {
         venue: string
         bands: array of strings
@@ -12,77 +14,224 @@ Most functions return an array of JSON-formattable event objects, which follow t
     }
 """
 
+import asyncio
 import datetime
-import json
+import io
 import re
+import time
+from urllib.parse import urlencode
 
-import requests
+import aiohttp
+import diskcache
 
 import dateutil
 import dateutil.parser
-import demjson
-from bs4 import BeautifulSoup
+import dateutil.tz
+import lxml.html
+import orjson
+import pyjson5
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
 
+try:
+    import html5_parser
+except (ImportError, RuntimeError):
+    # RuntimeError is raised when html5-parser and lxml are built against different libxml2 versions
+    html5_parser = None
 
-class Event:
-    """A single event parsed from an event calendar.
 
-    Attributes:
-        venue: (str) where the event will take place
-        bands: (list) array of bands performing at the event
-        start: (datetime) when the event starts
-        link: (str) a hyperlink to the event website
-        soldout: (bool) whether the event is sold out or not
+def _class_test(name):
+    """Build an XPath predicate that matches elements whose class attribute contains the given class name."""
+    return 'contains(concat(" ", normalize-space(@class), " "), " {0} ")'.format(name)
+
+
+# Precompiled XPath expressions for the Bowery Boston event calendar
+_XP_SHOWS = etree.XPath('//div[{0}]'.format(_class_test('show-item')))
+_XP_LINK = etree.XPath('.//a/@href', smart_strings=False)
+_XP_START = etree.XPath('.//a[{0} and {1}]/@data-start'.format(
+    _class_test('calendar-dropdown-item'), _class_test('google')), smart_strings=False)
+_XP_VENUE = etree.XPath('.//p[{0}]//strong'.format(_class_test('list-location')))
+_XP_INFO_TITLE = etree.XPath('.//div[{0}]'.format(_class_test('info-title')))
+_XP_HEADLINER = etree.XPath('.//a')
+_XP_SUPPORT = etree.XPath('.//div[{0}]//span'.format(_class_test('supporting-acts')))
+_XP_TICKET = etree.XPath('.//a[{0} and {1} and {2} and {3}]'.format(
+    _class_test('button'), _class_test('event'), _class_test('ticket'), _class_test('primary')))
+_WITH_PREFIX_RE = re.compile(r'^with\s*')
+
+# Number of Bowery events handed to an executor worker at a time
+_BOWERY_CHUNK_SIZE = 64
+
+
+# Middle East calendar pages embed their events as a JavaScript array literal
+_ME_EVENTS_RE = re.compile(r'events: (\[.*?])', re.S)
+_BAND_SPLIT_RE = re.compile(r'[,|]')
+
+# Crossroads Presents venues as (display name, calendar URL slug)
+CROSSROADS_VENUES = [
+    ('Paradise Rock Club', 'paradise-rock-club'),
+    ('Brighton Music Hall', 'brighton-music-hall')
+]
+
+# System local time zone; unlike a fixed offset it applies the DST rules in effect on each event's date
+_LOCAL_TZ = dateutil.tz.tzlocal()
+
+# Disk-backed response cache shared by all venue requests, enabled with install_cache()
+_cache = None
+_cache_expire = 0
+_cache_stale_expire = 0
+
+
+def install_cache(directory, expire_after=3600, stale_expire=86400):
+    """Cache successful responses on disk so repeated runs skip the network.
+
+    Cached responses newer than expire_after are returned without a request. Responses newer than
+    stale_expire are served as a fallback if the venue cannot be reached or returns a server error;
+    this is kept short because the Crossroads URLs are relative to the current month.
+
+    Args:
+        directory: the directory to store the cache in
+        expire_after: number of seconds a cached response is considered fresh
+        stale_expire: number of seconds a cached response may still be used when a request fails
     """
 
-    def __init__(self, venue='', bands=[], start=datetime.datetime.today(),
-                 link='', soldout=False):
-        """Init Event with optional attributes."""
-        # self.venue = venue
-        # self.bands = bands
-        # self.start = start
-        # self.link = link
-        # self.soldout = soldout
-        self.__dict__.update({k: v for k, v in locals().items() if k != 'self'})
-
-    def to_json(self):
-        """Convert Event to a generic object.
-
-        Returns:
-            Object
-        """
-        return {
-            'venue': self.venue,
-            'bands': self.bands,
-            'start': self.start.isoformat(),
-            'link': self.link,
-            'soldout': self.soldout
-        }
+    global _cache, _cache_expire, _cache_stale_expire
+    _cache = diskcache.Cache(str(directory))
+    _cache_expire = expire_after
+    _cache_stale_expire = stale_expire
 
 
-def bowery_shows():
-    """Retrieve all events for the next 12 months that are managed by Bowery Boston.
+async def fetch(session, url, params=None):
+    """Request a single page using a shared aiohttp session.
 
+    Args:
+        session: the aiohttp.ClientSession to issue the request with
+        url: the URL to request
+        params: optional query string parameters
     Returns:
-        an array of JSON event objects
+        a tuple of (HTTP status code, raw response body as bytes, charset declared by the response or None)
     """
-    
+
+    if _cache is None:
+        async with session.get(url, params=params) as r:
+            return r.status, await r.read(), r.charset
+
+    # diskcache is synchronous, so keep its SQLite reads and writes of large bodies off the event loop
+    key = '{0}?{1}'.format(url, urlencode(params)) if params else url
+    cached = await asyncio.to_thread(_cache.get, key)
+    age = time.time() - cached[0] if cached else None
+    if cached and age < _cache_expire:
+        return cached[1:]
+    stale = cached if cached and age < _cache_stale_expire else None
+    try:
+        async with session.get(url, params=params) as r:
+            status, body, charset = r.status, await r.read(), r.charset
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        if stale:
+            return stale[1:]
+        raise
+    if status == 200:
+        await asyncio.to_thread(_cache.set, key, (time.time(), status, body, charset))
+    elif status >= 500 and stale:
+        return stale[1:]
+    return status, body, charset
+
+
+async def bowery_shows(session, pool=None):
+    """Retrieve all events for the next 12 months that are managed by Bowery Boston.
+
+    The page is split into events in a worker thread, and the events are parsed in chunks on the given
+    executor, so the other venue requests keep running meanwhile.
+
+    Args:
+        session: the aiohttp.ClientSession to issue requests with
+        pool: an optional concurrent.futures executor (e.g. a ProcessPoolExecutor) to parse events in;
+            defaults to the event loop's default executor
+    Yields:
+        JSON-formattable event objects, in calendar order, as each chunk finishes parsing
+    """
+
+    status, body, charset = await fetch(
+        session, 'https://www.boweryboston.com/info/events/get?scope=all&page=0&rows=9999&venues=boston')
+    if status != 200 or not body.strip():
+        return
     print("Parsing Bowery Boston event calendar...")
-    events_list = []
-    r = requests.get(
-        'https://www.boweryboston.com/info/events/get?scope=all&page=0&rows=9999&venues=boston')
-    soup = BeautifulSoup(r.text, 'html.parser')
-    events = soup.find_all('div', class_='show-item')
-    for e in events:
-        events_list.append(bowery_event_process(e))
-    return events_list
+    # Splitting the page is a full parse of a multi-MB document, so it runs off the event loop as well
+    fragments = await asyncio.to_thread(bowery_show_fragments, body, charset or 'utf-8')
+    del body
+    loop = asyncio.get_running_loop()
+    chunks = [loop.run_in_executor(pool, bowery_process_chunk, fragments[i:i + _BOWERY_CHUNK_SIZE])
+              for i in range(0, len(fragments), _BOWERY_CHUNK_SIZE)]
+    del fragments
+    try:
+        while chunks:
+            for ev in await chunks.pop(0):
+                yield ev
+    finally:
+        for chunk in chunks:
+            chunk.cancel()
+
+
+def bowery_show_fragments(body, encoding='utf-8'):
+    """Extract the HTML of each event from the Bowery Boston event calendar.
+
+    Uses html5-parser to build the document tree in C when it is installed. Otherwise the page is parsed
+    incrementally with lxml and each event is discarded as soon as it has been serialized.
+
+    Args:
+        body: the raw HTML of the event calendar as bytes
+        encoding: the character encoding of body. The calendar is an HTML fragment without a <meta charset>,
+            so without this libxml2 would assume Latin-1
+    Returns:
+        the HTML source of each event (div class show-item) as bytes
+    """
+
+    # lxml raises on a document with no elements at all
+    if not body.strip():
+        return []
+
+    if html5_parser is not None:
+        root = html5_parser.parse(body, transport_encoding=encoding)
+        return [lxml.html.tostring(e, with_tail=False) for e in _XP_SHOWS(root)]
+
+    fragments = []
+    for _, e in etree.iterparse(io.BytesIO(body), tag='div', html=True, encoding=encoding):
+        if 'show-item' in (e.get('class') or '').split():
+            fragments.append(lxml.html.tostring(e, with_tail=False))
+            e.clear(keep_tail=True)
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+    return fragments
+
+
+def bowery_process_chunk(fragments):
+    """Parse a batch of Bowery Boston events.
+
+    Args:
+        fragments: the HTML source of each event (div class show-item) as bytes
+    Returns:
+        an array of JSON-formattable event objects
+    """
+
+    return [bowery_event_process_html(f) for f in fragments]
+
+
+def bowery_event_process_html(fragment):
+    """Parse a single event from the Bowery Boston event calendar given as an HTML string.
+
+    Args:
+        fragment: the HTML source of a single event (div class show-item)
+    Returns:
+        a JSON-formattable event object
+    """
+
+    return bowery_event_process(lxml.html.fromstring(fragment))
 
 
 def bowery_event_process(e):
-    """Parse a single BeautifulSoup-formatted event from the Bowery Boston event calendar.
+    """Parse a single lxml-formatted event from the Bowery Boston event calendar.
 
     Args:
-        e: a single event (div class show-item) from the Bowery Boston event calendar in HTML format
+        e: a single event (div class show-item) from the Bowery Boston event calendar as an lxml element
     Returns:
         a JSON-formattable event object
     """
@@ -96,136 +245,159 @@ def bowery_event_process(e):
     #                       data-start="2018-04-12T00:15:00Z" data-title="Lucy Dacus" href="" target="_blank">
     #          Sold Out: <a class="button event ticket primary" href="http://www.axs.com/events/347671/lucy-dacus-tickets" id="48591" target="_blank">Sold Out
 
-    ev = Event()
+    venue = ''
     bands = []
+    start = None
+    link = ''
+    soldout = False
 
-    cursor = e.find('a')
+    cursor = _XP_LINK(e)
     if cursor:
-        ev.link = 'https://www.boweryboston.com{0}'.format(
-            cursor['href'])
+        link = 'https://www.boweryboston.com{0}'.format(cursor[0])
 
-    cursor = e.select_one("a.calendar-dropdown-item.google")
+    cursor = _XP_START(e)
     if cursor:
-        ev.start = dateutil.parser.parse(
-            cursor['data-start']).astimezone(dateutil.tz.tzlocal())
+        start = datetime.datetime.fromisoformat(
+            cursor[0].replace('Z', '+00:00')).astimezone()
 
-    cursor = e.find('p', class_='list-location').find('strong')
+    cursor = _XP_VENUE(e)
     if cursor:
-        ev.venue = cursor.get_text(strip=True)
+        venue = cursor[0].text_content().strip()
 
-    artist_info = e.find('div', class_='info-title')
+    artist_info = _XP_INFO_TITLE(e)
     if artist_info:
-        cursor = artist_info.find('a')
+        cursor = _XP_HEADLINER(artist_info[0])
         if cursor:
-            if cursor.get_text(strip=True):
-                bands.append(cursor.get_text(strip=True))
+            headliner = cursor[0].text_content().strip()
+            if headliner:
+                bands.append(headliner)
 
-        cursor = e.find('div', 'supporting-acts')
+        cursor = _XP_SUPPORT(e)
         if cursor:
-            supp_arr = re.sub(
-                r'^with\s*', '', cursor.find('span').get_text(strip=True)).split(', ')
+            supp_arr = _WITH_PREFIX_RE.sub(
+                '', cursor[0].text_content().strip()).split(', ')
             for i in supp_arr:
                 if i:
                     bands.append(i)
 
-    ev.bands = bands
-
-    cursor = e.select_one('a.button.event.ticket.primary')
+    cursor = _XP_TICKET(e)
     if cursor:
-        if cursor.get_text(strip=True).lower() == 'sold out':
-            ev.soldout = True
-
-    return ev.to_json()
+        if cursor[0].text_content().strip().lower() == 'sold out':
+            soldout = True
+
+    return {
+        'venue': venue,
+        'bands': bands,
+        'start': (start or datetime.datetime.today()).isoformat(),
+        'link': link,
+        'soldout': soldout
+    }
 
 
-def houseofblues():
+async def houseofblues(session):
     """Retrieve all events for the next 12 months that are managed by House of Blues Boston.
 
-    Returns:
-        an array of JSON-formattable event objects
+    Args:
+        session: the aiohttp.ClientSession to issue requests with
+    Yields:
+        JSON-formattable event objects
     """
 
-    print("Parsing House of Blues event calendar...")
-    events_list = []
     start_date = datetime.datetime.today()
     base_url = 'http://www.houseofblues.com/boston/api/EventCalendar/GetEvents'
     url_params = {'startDate': start_date.strftime('%m/%d/%Y'), 'endDate': start_date.replace(year=start_date.year+1).strftime('%m/%d/%Y'),
                   'venueIds': 9044, 'limit': 9999, 'offset': 1, 'genre': '', 'artist': '', 'offerType': 'STANDARD,STANDARD - Priority'}
-    r = requests.get(base_url, params=url_params)
-    ftext = re.sub(r'\\"', '"', r.text[1:-1], flags=re.S)
-    rawobj = json.loads(ftext)
+    status, body, charset = await fetch(session, base_url, params=url_params)
+    print("Parsing House of Blues event calendar...")
+    ftext = body.decode(charset or 'utf-8', 'replace')[1:-1].replace('\\"', '"')
+    rawobj = orjson.loads(ftext)
     for i in rawobj['result']:
         artist_array = i['artists']
         bands = [artist_array.pop(0)['name']]
+        title = i['title'].lower()
         for a in artist_array:
-            if a['name'].lower().encode('ascii', 'ignore') != i['title'].lower().encode('ascii', 'ignore'):
+            if a['name'].lower() != title:
                 bands.append(a['name'])
-        ev = Event(venue=i['venueName'], bands=bands, start=dateutil.parser.parse(i['eventDate']).replace(tzinfo=dateutil.tz.tzlocal()),
-                   link='http://www.houseofblues.com/boston/EventDetail?tmeventid={0}&offerid=0'.format(i['eventID']))
-        if i['soldOut']:
-            ev.soldout = True
-        events_list.append(ev.to_json())
-    return events_list
+        yield {
+            'venue': i['venueName'],
+            'bands': bands,
+            'start': dateutil.parser.parse(i['eventDate']).replace(tzinfo=_LOCAL_TZ).isoformat(),
+            'link': 'http://www.houseofblues.com/boston/EventDetail?tmeventid={0}&offerid=0'.format(i['eventID']),
+            'soldout': bool(i['soldOut'])
+        }
 
 
-def monthly_cals():
+async def monthly_cals(session):
     """Parse the venue calendars with request structures that are limited to one month at a time.
 
-    Returns:
-        An array of JSON-formattable event objects
+    All months are requested concurrently. Each calendar is parsed, in month order, as soon as its response
+    has arrived, and its response body is released once its events have been yielded.
+
+    Args:
+        session: the aiohttp.ClientSession to issue requests with
+    Yields:
+        JSON-formattable event objects
     """
 
-    events_list = []
     today = datetime.datetime.today().replace(day=1)
     cur_date = [today.month, today.year]
+    # Each calendar is (label, month string, URL, parsing function taking the body and its charset)
+    calendars = []
     for period in range(0, 12):
         cur_date[0] += 1
         if cur_date[0] > 12:
             cur_date[0] = 1
             cur_date[1] += 1
         date_string = '{0}/{1}'.format(cur_date[0], cur_date[1])
-        r = requests.get(
-            'http://www.mideastoffers.com/all-shows/?cal-month={0}&cal-year={1}'.format(cur_date[0], cur_date[1]))
-        if r.status_code == 200:
-            print('Parsing Middle East event calendar for {0}...'.format(
-                date_string))
-            events_list += middleeast(r.text)
-        r = requests.get(
-            'http://events.crossroadspresents.com/venues/paradise-rock-club/month_events.json?period={0}'.format(period))
-        if r.status_code == 200:
-            print('Parsing Paradise Rock Club event calendar for {0}...'.format(
-                date_string))
-            events_list += crossroads_parse(r.json())
-        r = requests.get(
-            'http://events.crossroadspresents.com/venues/brighton-music-hall/month_events.json?period={0}'.format(period))
-        if r.status_code == 200:
-            print('Parsing Brighton Music Hall event calendar for {0}...'.format(
-                date_string))
-            events_list += crossroads_parse(r.json())
-    return events_list
+        calendars.append(('Middle East', date_string,
+                          'http://www.mideastoffers.com/all-shows/?cal-month={0}&cal-year={1}'.format(cur_date[0], cur_date[1]),
+                          lambda body, charset: middleeast(body.decode(charset or 'utf-8', 'replace'))))
+        for label, slug in CROSSROADS_VENUES:
+            calendars.append((label, date_string,
+                              'http://events.crossroadspresents.com/venues/{0}/month_events.json?period={1}'.format(slug, period),
+                              lambda body, charset: crossroads_parse(orjson.loads(body))))
+
+    requests = [asyncio.ensure_future(fetch(session, url)) for _, _, url, _ in calendars]
+    try:
+        for label, date_string, url, parse in calendars:
+            status, body, charset = await requests.pop(0)
+            if status == 200:
+                print('Parsing {0} event calendar for {1}...'.format(
+                    label, date_string))
+                for ev in parse(body, charset):
+                    yield ev
+    finally:
+        for request in requests:
+            request.cancel()
 
 
 def middleeast(data):
     """Retrieve all events for the next 12 months happening at the Middle East venue.
 
-    Returns:
-        an array of JSON-formattable event objects
+    Yields:
+        JSON-formattable event objects
     """
-    events_list = []
-    regtest = re.search(r'events: (\[.*?])', data, flags=re.S)
+    regtest = _ME_EVENTS_RE.search(data)
     if regtest:
-        obj = demjson.decode(regtest.group(1))
+        obj = pyjson5.loads(regtest.group(1))
         for i in obj:
             try:
-                ventext = re.search(r'<div[^<>]*>([^<]+)', i['venue']).group(1)
-                ev = Event(venue=ventext, bands=[x.strip() for x in re.split(r',|\|', i['title'])],
-                           start=datetime.datetime.strptime(
-                               i['start'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=dateutil.tz.tzlocal()),
-                           link='http://www.mideastoffers.com/event/' + i['id'])
-                events_list.append(ev.to_json())
+                # Only the first text run of the div, as in '<div>Upstairs<br>...'
+                first = LexborHTMLParser(i['venue']).css_first('div').child
+                ventext = first.text_content.strip() if first is not None and first.tag == '-text' else ''
+                if not ventext:
+                    continue
+                event = {
+                    'venue': ventext,
+                    'bands': [x.strip() for x in _BAND_SPLIT_RE.split(i['title'])],
+                    'start': datetime.datetime.strptime(
+                        i['start'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=_LOCAL_TZ).isoformat(),
+                    'link': 'http://www.mideastoffers.com/event/' + i['id'],
+                    'soldout': False
+                }
             except:
-                pass
-    return events_list
+                continue
+            yield event
 
 
 def crossroads_parse(data):
@@ -233,8 +405,8 @@ def crossroads_parse(data):
 
     Args:
         data: the raw JSON data to parse
-    Returns:
-        an array of JSON-formattable event objects
+    Yields:
+        JSON-formattable event objects
     """
 
     # JSON object format example (truncated):
@@ -255,13 +427,13 @@ def crossroads_parse(data):
     #     }]
     # }
 
-    events_list = []
     for g in data['event_groups']:
         for e in g['events']:
             if e['category_param'] == 'music':
-                ev = Event(venue=e['venue']['title'], bands=[x['title'] for x in e['artists']] if e['artists'] else [e['title']],
-                           start=dateutil.parser.parse(e['tz_adjusted_begin_date']), link='http://events.crossroadspresents.com' + e['permalink'])
-                if e['sold_out']:
-                    ev.soldout = True
-                events_list.append(ev.to_json())
-    return events_list
+                yield {
+                    'venue': e['venue']['title'],
+                    'bands': [x['title'] for x in e['artists']] if e['artists'] else [e['title']],
+                    'start': datetime.datetime.fromisoformat(e['tz_adjusted_begin_date']).isoformat(),
+                    'link': 'http://events.crossroadspresents.com' + e['permalink'],
+                    'soldout': bool(e['sold_out'])
+                }